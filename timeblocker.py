@@ -2,14 +2,21 @@
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType
 import sys
-import collections
+import heapq
 import io
 import matplotlib.dates as dates
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.collections import PatchCollection
+import numpy as np
 import pyfsdb
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # set the default font size
 matplotlib.rcParams.update({'font.size': 22})
 
@@ -69,110 +76,156 @@ def parse_args():
 
 
 def read_data(input_file_handle, columns, positives_column, time_step):
+    """Reads the begin, end and positives columns into an (N, 3) int64
+    array, with begin times rounded down and end times rounded up to
+    the nearest time_step."""
     fh = pyfsdb.Fsdb(file_handle=input_file_handle)
-    column_numbers = fh.get_column_numbers(columns)
-    positive_column = -1
+    usecols = fh.get_column_numbers(columns)
+    if positives_column:
+        usecols.append(fh.get_column_number(positives_column))
+
+    if fh.separator == "\t":
+        # the header has been read, so let numpy parse the remaining rows;
+        # only lines starting with a # are comments, as fields may hold one
+        lines = (line for line in fh.file_handle if not line.startswith("#"))
+        values = np.loadtxt(lines, delimiter="\t", comments=None,
+                            usecols=usecols, ndmin=2)
+    else:
+        rows = (tuple(row[column] for column in usecols) for row in fh)
+        values = np.fromiter(rows, dtype=(np.float64, len(usecols)))
+
+    begin_times = values[:, 0].astype(np.int64)
+    begin_times -= begin_times % time_step
+
+    # jump to the next time_step looking forward
+    end_times = values[:, 1]
+    remainders = np.mod(end_times, time_step)
+    end_times = np.where(remainders != 0,
+                         end_times - remainders + time_step,
+                         end_times).astype(np.int64)
+
+    positives = np.ones(len(values), dtype=np.int64)
     if positives_column:
-        positive_column = fh.get_column_number(positives_column)
-    data = []
-    for row in fh:
-        begin_time = int(float(row[column_numbers[0]]))
-        begin_time = begin_time - begin_time % time_step
+        positives = values[:, 2].astype(np.int64)
+
+    return np.column_stack((begin_times, end_times, positives))
+
 
-        end_time = float(row[column_numbers[1]])
-        if (end_time % time_step) != 0:
-            # jump to the next time_step looking forward
-            end_time = end_time - (end_time % time_step) + time_step
-        end_time = int(end_time)
+def jit_kernel(*args, **kwargs):
+    "Compiles a function with numba when available, otherwise leaves it as is."
+    if numba is None:
+        return lambda function: function
+    return numba.njit(*args, **kwargs)
 
-        positives = 1
-        if positive_column != -1:
-            positives = row[positive_column]
 
-        data.append([begin_time, end_time, positives])
+# the end time stored for heights that have never held a block
+NEVER_USED_END = np.iinfo(np.int64).min
+
+
+@jit_kernel('int64[:](int64[:], int64[:], int64)', cache=True,
+            boundscheck=False, error_model='numpy', fastmath=True)
+def _assign_heights(begins, ends, minimum_time_offset):
+    """Returns the lowest free height for each block, where a height is
+    free once its previous block (plus minimum_time_offset) has ended
+    by the time the next block begins."""
+    count = len(begins)
+    heights = np.zeros(count, dtype=np.int64)
+
+    # the end time of the block currently occupying each height
+    active_end = np.full(64, NEVER_USED_END, dtype=np.int64)
+    max_height = 0
+
+    for i in range(count):
+        limit = begins[i] - minimum_time_offset
+
+        # find the lowest height whose block has already finished; the
+        # height above max_height is always unused, which ends the scan
+        height = 1
+        while active_end[height] > limit:
+            height += 1
+
+        if height > max_height:
+            max_height = height
+            if max_height + 1 >= len(active_end):
+                grown = np.full(len(active_end) * 2, NEVER_USED_END,
+                                dtype=np.int64)
+                grown[:len(active_end)] = active_end
+                active_end = grown
 
-    return data
+        active_end[height] = ends[i]
+        heights[i] = height
 
+    return heights
 
-# stores the number of times we saw something at this height
-height_counts = collections.Counter()
 
+def _assign_heights_heap(begins, ends, minimum_time_offset):
+    """A pure python version of _assign_heights for use without numba,
+    which keeps the free heights in a heap rather than scanning for
+    them."""
+    heights = np.zeros(len(begins), dtype=np.int64)
+    free_heights = []  # heap of heights whose blocks have finished
+    active = []        # heap of (end_time, height) for blocks in use
+    max_height = 0
 
-def add_points(found_points, found_heights, output_chart, height_data):
-    "collects found points and heights into the final chart"
-    def key2(x):
-        return x[1]
+    for i, (begin_time, end_time) in enumerate(zip(begins.tolist(),
+                                                   ends.tolist())):
+        # release the heights of blocks that have finished
+        while active and active[0][0] <= begin_time - minimum_time_offset:
+            heapq.heappush(free_heights, heapq.heappop(active)[1])
 
-    # sort the results by reverse length (longest first) and add to the results
-    found_points = sorted(found_points, key=key2, reverse=True)
+        if free_heights:
+            height = heapq.heappop(free_heights)
+        else:
+            max_height += 1
+            height = max_height
 
-    for point, h in zip(found_points, found_heights):
-        height_data[h] = point[1]
-        point.append(h)
+        heapq.heappush(active, (end_time, height))
+        heights[i] = height
 
-    output_chart.extend(found_points)
+    return heights
 
 
 def create_chart(data, timestep, min_time_block_offset=0):
-    """Creates an series of output 'blocks' to print, with values of
-    start_time, end_time, height.  Input data must be time-sorted by 
-    start_time value (column 0).
+    """Creates an (N, 4) array of output 'blocks' to print, with values of
+    start_time, end_time, positives, height.  Blocks are placed in
+    start_time order, with the longest blocks starting at a given time
+    placed lowest.
 
     """
-    output_chart = []    # list of ending times for a block
-    height_data = {}     # timestamps of when a particular height ends
-    last_time = 0
+    data = np.asarray(data, dtype=np.int64).reshape(-1, 3)
+    data = data[np.lexsort((-data[:, 1], data[:, 0]))]
     minimum_time_offset = timestep * min_time_block_offset
 
-    found_points = []  # [start_time, end_time]
-    found_heights = []  # height of current
-    height = 1
-
-    # for each row of data, find a free block height for it
-    for row in data:
-        (begin_time, end_time, positives) = row
-
-        # we found a new time-point, do clean up from the last
-        if begin_time > last_time:
-            # drop old used markers
-            new_height_data = {}
-            for value in height_data:
-                if height_data[value] + minimum_time_offset > begin_time:
-                    new_height_data[value] = height_data[value]
-            height_data = new_height_data
-
-            add_points(found_points, found_heights,
-                       output_chart, height_data)
-
-            found_points = []
-            found_heights = []
-            found_positives = []
-            height = 0
-
-        # find a vertical height at which there is no block in height_data
-        height += 1
-        while height in height_data:
-            height += 1
-
-        # remember this point in a list to add at the end of the time period
-        found_points.append([begin_time, end_time, positives])
-        found_heights.append(height)  # record the height it should be plotted at
-        found_positives.append(positives)
-        height_counts[height] += 1
+    assign_heights = _assign_heights
+    if numba is None:
+        assign_heights = _assign_heights_heap
 
-        last_time = begin_time
-
-    add_points(found_points, found_heights, output_chart, height_data)
+    output_chart = np.empty((len(data), 4), dtype=np.int64)
+    output_chart[:, :3] = data
+    output_chart[:, 3] = assign_heights(data[:, 0], data[:, 1],
+                                        minimum_time_offset)
 
     return output_chart
 
 
 def output_to_fsdb(chart_data, output_file_name, column_names):
-    """Writes the chart as a FSDB file with start, end, and height values"""
-    outh = pyfsdb.Fsdb(out_file=output_file_name)
+    """Writes the chart as a FSDB file with start, end, positives and
+    height values"""
+    if output_file_name:
+        outh = pyfsdb.Fsdb(out_file=output_file_name)
+    else:
+        outh = pyfsdb.Fsdb(out_file_handle=sys.stdout)
     outh.out_column_names = column_names + ['height']
-    for row in chart_data:
-        outh.append(row)
+    rows = np.asarray(chart_data, dtype=np.int64).reshape(-1, 4).tolist()
+    if rows:
+        # the first append writes the (typed) header and, as a side effect
+        # pyfsdb relies on, sets out_separator and switches append over to
+        # direct writes; only then is it safe to write the remaining rows
+        # to the handle ourselves in one go
+        outh.append(rows[0])
+        separator = outh.out_separator
+        outh.out_file_handle.write(
+            "".join(separator.join(map(str, row)) + "\n" for row in rows[1:]))
     outh.close()
 
 
@@ -181,44 +234,41 @@ def draw_chart(chart_data, out_file_name, gap_width=0, bar_height=.9):
     # Create figure and axes
     fig, ax = plt.subplots(1)
 
-    # create rectangles
-    max_height = 0
-    max_time = 0
+    face_colors = np.array(['darkviolet', 'crimson'])
+    negative_colors = np.array(['aqua', 'lime'])
 
-    face_colors = ['darkviolet', 'crimson']
-    edge_colors = face_colors
-    negative_colors = ['aqua', 'lime']
+    chart = np.asarray(chart_data, dtype=np.int64).reshape(-1, 4)
+    end_times = chart[:, 1]
+    heights = chart[:, 3]
+    max_height = int(heights.max())
+    max_time = int(end_times.max())
 
-    heights_seen = collections.Counter()
+    # refactor times into ones matplotlib can understand
+    start_times = dates.epoch2num(chart[:, 0])
+    time_widths = dates.epoch2num(end_times - gap_width) - start_times
 
-    for row in chart_data:
-        (start_time, end_time, positives, height) = row
+    # alternate colors between neighboring blocks at the same height
+    # by numbering each block among the others at its height
+    order = np.argsort(heights, kind="stable")
+    sorted_heights = heights[order]
+    alternates = np.empty(len(heights), dtype=np.int64)
+    alternates[order] = np.arange(1, len(heights) + 1) - \
+        np.searchsorted(sorted_heights, sorted_heights)
+    alternates %= len(face_colors)
 
-        if height > max_height:
-            max_height = height
-        if end_time > max_time:
-            max_time = end_time
-
-        # refactor times into ones matplotlib can understand
-        start_time = dates.epoch2num(start_time)
-        time_width = dates.epoch2num(end_time - gap_width) - start_time
-
-        heights_seen[height] += 1
-        facecolor = None
-        positives = int(positives)
-        if positives > 0:
-            facecolor = face_colors[heights_seen[height] % len(edge_colors)]
-            edgecolor = edge_colors[heights_seen[height] % len(edge_colors)]
-        else:
-            facecolor = negative_colors[heights_seen[height] % len(negative_colors)]
-            edgecolor = facecolor
-        rect = patches.Rectangle((start_time, height),
-                                 time_width, bar_height,
-                                 edgecolor=edgecolor,
-                                 facecolor=facecolor,
-                                 linewidth=3)
+    colors = np.where(chart[:, 2] > 0,
+                      face_colors[alternates], negative_colors[alternates])
+
+    # create rectangles
+    rects = [patches.Rectangle((start_time, height), time_width, bar_height)
+             for (start_time, time_width, height) in
+             zip(start_times, time_widths, heights.tolist())]
 
-        ax.add_patch(rect)
+    # add all the rectangles as a single artist
+    ax.add_collection(PatchCollection(rects,
+                                      facecolors=colors,
+                                      edgecolors=colors,
+                                      linewidths=3))
 
     # set the boundaries of the graph
     if gap_width == 0:
@@ -254,48 +304,68 @@ def main():
     chart = create_chart(data, args.time_step,
                          min_time_block_offset=args.min_time_block)
     if args.output_fsdb:
-        output_to_fsdb(chart, args.output_file)
+        positives_column = args.positive_column or 'positives'
+        output_to_fsdb(chart, args.output_file,
+                       args.time_columns + [positives_column])
     else:
         draw_chart(chart, args.output_file, args.gap_width, args.block_height)
 
 
 def test_algorithm():
     time_separator = 2
-    input_data = [[4, 6],
-                  [4, 8],
-                  [6, 10],
-                  [6, 8]]
-    expected_results = [[4, 6, 1],
-                        [4, 8, 2],
-                        [6, 10, 1],
-                        [6, 8, 3]]
+    input_data = [[4, 6, 1],
+                  [4, 8, 1],
+                  [6, 10, 1],
+                  [6, 8, 1]]
+    expected_results = [[4, 8, 1, 1],
+                        [4, 6, 1, 2],
+                        [6, 10, 1, 2],
+                        [6, 8, 1, 3]]
     results = create_chart(input_data, time_separator)
-    assert results == expected_results
+    assert results.tolist() == expected_results
 
     # add a minimum of a single block break between one block and the next
     minimum_spacing = 1
-    input_data = [[4, 6],
-                  [4, 8],
-                  [6, 10],
-                  [6, 8]]
-    offset_expected_results = [[4, 6, 1],
-                        [4, 8, 2],
-                        [6, 10, 3],
-                        [6, 8, 4]]
+    input_data = [[4, 6, 1],
+                  [4, 8, 1],
+                  [6, 10, 1],
+                  [6, 8, 1]]
+    offset_expected_results = [[4, 8, 1, 1],
+                        [4, 6, 1, 2],
+                        [6, 10, 1, 3],
+                        [6, 8, 1, 4]]
     results = create_chart(input_data, time_separator, min_time_block_offset=minimum_spacing)
-    assert results == offset_expected_results
+    assert results.tolist() == offset_expected_results
+
+    # the heap based fallback must pick the same heights as the kernel
+    begins = np.array([4, 4, 4, 6, 6, 8, 12, 12], dtype=np.int64)
+    ends = np.array([6, 12, 8, 10, 8, 14, 14, 16], dtype=np.int64)
+    for offset in [0, 2, 4]:
+        assert (_assign_heights(begins, ends, offset) ==
+                _assign_heights_heap(begins, ends, offset)).all()
 
     # try again with deviations
     f_stream = io.StringIO("#fsdb -F t left right\n4.1\t5.5\n5.8\t7.9\n6\t8.1\n6\t6.9\n")
-    input_data = read_data(f_stream, ['left', 'right'], time_separator)
-    rounded_data = [[4, 6],
-                    [4, 8],
-                    [6, 10],
-                    [6, 8]]
-    assert input_data == rounded_data
+    input_data = read_data(f_stream, ['left', 'right'], None, time_separator)
+    rounded_data = [[4, 6, 1],
+                    [4, 8, 1],
+                    [6, 10, 1],
+                    [6, 8, 1]]
+    assert input_data.tolist() == rounded_data
 
     results = create_chart(input_data, time_separator)
-    assert results == expected_results
+    assert results.tolist() == expected_results
+
+    # a # inside a field is data, not the start of a comment
+    f_stream = io.StringIO("#fsdb -F t name left right\n"
+                           "http://x/#frag\t4\t6\n# a comment\n")
+    input_data = read_data(f_stream, ['left', 'right'], None, time_separator)
+    assert input_data.tolist() == [[4, 6, 1]]
+
+    # non-tab separated files are parsed row by row
+    f_stream = io.StringIO("#fsdb -F s left right\n4.1 5.5\n5.8 7.9\n6 8.1\n6 6.9\n")
+    input_data = read_data(f_stream, ['left', 'right'], None, time_separator)
+    assert input_data.tolist() == rounded_data
 
 
 if __name__ == "__main__":